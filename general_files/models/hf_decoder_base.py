@@ -35,16 +35,24 @@ class ModelNet(BasePLModel):
                 **other_features  # 如果有其他特征参数，建议加decoder前缀，保持框架一致性
                 ):
         result = Result()
+        # attention_mask 始终覆盖完整序列，包括已缓存的前缀
+        attention_mask = input_ids.ne(self.tokenizer.pad_token_id)
+        past_key_values = past_result.get('past_key_values') if past_result is not None else None
+        if past_key_values is not None:
+            # 前缀的 key/value 已缓存，只需输入最新生成的 token
+            input_ids = input_ids[:, -1:]
         outputs = self.backbone(input_ids=input_ids,
                                 output_hidden_states=True,
                                 output_attentions=True,
                                 labels=torch.where(
                                     labels == self.tokenizer.pad_token_id, -100, labels) if labels is not None else None,
-                                attention_mask=input_ids.ne(
-                                    self.tokenizer.pad_token_id),
+                                attention_mask=attention_mask,
+                                past_key_values=past_key_values,
                                 use_cache=True,
                                 )
         result.add(logits=outputs['logits'])
+        if labels is None:
+            result.add(past_key_values=outputs['past_key_values'])
         if self.stage != "test":
             result.add(labels=labels)
             result.add(loss=outputs['loss'], lm_loss=outputs['loss'])
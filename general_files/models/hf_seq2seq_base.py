@@ -42,15 +42,31 @@ class ModelNet(BasePLModel):
         **other_features  # 如果有其他特征参数，建议加decoder前缀，保持框架一致性
     ):
         result = Result()
+        decoder_input_ids = other_features.get("decoder_input_ids")
+        past_key_values, encoder_outputs = None, None
+        if past_result is not None:
+            # 生成时复用上一步的编码结果与解码器的 key/value，只需输入最新生成的 token
+            past_key_values = past_result.get("past_key_values")
+            encoder_outputs = past_result.get("encoder_outputs")
+            if past_key_values is not None:
+                decoder_input_ids = decoder_input_ids[:, -1:]
         outputs = self.backbone(
             input_ids=input_ids,
+            decoder_input_ids=decoder_input_ids,
             labels=torch.where(labels == self.tokenizer.pad_token_id, -100, labels)
             if labels is not None
             else None,
             attention_mask=input_ids.ne(self.tokenizer.pad_token_id),
+            encoder_outputs=encoder_outputs,
+            past_key_values=past_key_values,
         )
         logits = torch.log_softmax(outputs["logits"], dim=-1)
         result.add(logits=logits)
+        if labels is None:
+            result.add(
+                past_key_values=outputs.get("past_key_values"),
+                encoder_outputs=(outputs["encoder_last_hidden_state"],),
+            )
         if labels is not None:
             result.add(labels=labels)
             loss = self.NLLLoss(logits=logits, labels=labels)
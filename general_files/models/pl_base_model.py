@@ -26,6 +26,7 @@ from transformers.optimization import (
     get_polynomial_decay_schedule_with_warmup,
 )
 from general_files.utils.common_util import Result
+from general_files.utils.data_util import to_device_tensor
 
 
 # update this and the import above to support new schedulers from transformers.optimization
@@ -103,7 +104,7 @@ class BasePLModel(pl.LightningModule):
         for key in batch.keys():
             if key not in ignore_keys:
                 try:
-                    other_features[key] = torch.LongTensor(batch[key]).to(self.device)
+                    other_features[key] = to_device_tensor(batch[key], self.device)
                 except ValueError as e:
                     other_features[key] = batch[key]
         return other_features
@@ -207,13 +207,13 @@ class Tokenizer(nn.Module):
                 results = ()
                 for inp in inputs:
                     if isinstance(inp[0], list):
-                        tokenized_inputs = [self.tokenizer(i,
-                                                          padding=padding,
-                                                          max_length=max_length,
-                                                          truncation=truncation,
-                                                          add_special_tokens=add_special_tokens,
-                                                          return_offsets_mapping=return_offsets_mapping,
-                                                          *args, **kwargs).data if i != [] else [] for i in inp]
+                        tokenized_inputs = self.tokenize_nested(inp,
+                                                                padding=padding,
+                                                                max_length=max_length,
+                                                                truncation=truncation,
+                                                                add_special_tokens=add_special_tokens,
+                                                                return_offsets_mapping=return_offsets_mapping,
+                                                                *args, **kwargs)
                         if only_input_ids:
                             tokenized_inputs = [ti['input_ids'] if ti != [] else [] for ti in tokenized_inputs]
                     else:
@@ -233,13 +233,13 @@ class Tokenizer(nn.Module):
                 results = Result()
                 for key in inputs.keys():
                     if isinstance(inputs[key][0], list):
-                        tokenized_inputs = [self.tokenizer(inp,
-                                                          padding=padding,
-                                                          max_length=max_length,
-                                                          truncation=truncation,
-                                                          add_special_tokens=add_special_tokens,
-                                                          return_offsets_mapping=return_offsets_mapping,
-                                                          *args, **kwargs).data if inp != [] else [] for inp in inputs[key]]
+                        tokenized_inputs = self.tokenize_nested(inputs[key],
+                                                                padding=padding,
+                                                                max_length=max_length,
+                                                                truncation=truncation,
+                                                                add_special_tokens=add_special_tokens,
+                                                                return_offsets_mapping=return_offsets_mapping,
+                                                                *args, **kwargs)
                         if only_input_ids:
                             tokenized_inputs = [ti['input_ids'] if ti != [] else [] for ti in tokenized_inputs]
                     else:
@@ -258,6 +258,29 @@ class Tokenizer(nn.Module):
                 raise Exception(
                     f"Tokenizer.forward(): 不支持的输入类型！期望获取dict或list类型，但是获取的是{str(type(inputs))}")
 
+    def tokenize_nested(self, nested_inputs, padding='do_not_pad', *args, **kwargs):
+        """
+        编码嵌套 list（每个样本包含多个句子），返回与输入对应的编码结果，空 list 对应 []
+        不按 batch 内最长句子 pad 时，将所有句子展平后只调用一次 tokenizer，减少多次调用 Rust 后端的开销
+        """
+        if padding in (True, 'longest') or kwargs.get('return_tensors') is not None:
+            return [self.tokenizer(inp, padding=padding, *args, **kwargs).data if inp != [] else []
+                    for inp in nested_inputs]
+        flat_inputs = [sent for inp in nested_inputs for sent in inp]
+        if len(flat_inputs) == 0:
+            return [[] for _ in nested_inputs]
+        flat_tokenized = self.tokenizer(flat_inputs, padding=padding, *args, **kwargs).data
+        results = []
+        start = 0
+        for inp in nested_inputs:
+            if inp == []:
+                results.append([])
+                continue
+            end = start + len(inp)
+            results.append({k: v[start:end] for k, v in flat_tokenized.items()})
+            start = end
+        return results
+
     def pad(self, inputs,
             pad_token=None,
             max_length=-1,
@@ -335,6 +358,21 @@ class Tokenizer(nn.Module):
                     decode_sents = decode_sents.replace(w, '')
         return decode_sents
 
+    def batch_decode(self, batch_sent_ids, skip_special_tokens=False, ignore_tokens=None, *args, **kwargs):
+        if self.tokenizer:
+            # 批量解码的便捷封装，HuggingFace 的 batch_decode 内部仍在 Python 中逐句调用 decode
+            decode_sents = self.tokenizer.batch_decode(batch_sent_ids, skip_special_tokens=skip_special_tokens,
+                                                       *args, **kwargs)
+            ###############################################
+            # 对忽略字符进行替代
+            ###############################################
+            if ignore_tokens:
+                for w in ignore_tokens:
+                    decode_sents = [sent.replace(w, '') for sent in decode_sents]
+            return decode_sents
+        return [self.decode(sent_ids, skip_special_tokens=skip_special_tokens, ignore_tokens=ignore_tokens,
+                            *args, **kwargs) for sent_ids in batch_sent_ids]
+
     def convert_tokens_to_ids(self, token, *args, **kwargs):
         if self.tokenizer is not None:
             return self.tokenizer.convert_tokens_to_ids(token, *args, **kwargs)
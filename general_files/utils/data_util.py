@@ -448,6 +448,18 @@ def dict_list_to_tensor(ori_list):
     return res
 
 
+def to_device_tensor(data, device, dtype=torch.long):
+    """将 list / ndarray 转为 tensor 并拷贝到指定设备
+
+    目标为 GPU 时先放入锁页内存再异步拷贝，避免每个字段都做一次同步的 H2D 拷贝；
+    无法转为规整 tensor 的数据（如不等长的嵌套 list）会抛出 ValueError
+    """
+    tensor = torch.as_tensor(data, dtype=dtype)
+    if torch.device(device).type == "cuda":
+        return tensor.pin_memory().to(device, non_blocking=True)
+    return tensor.to(device)
+
+
 def generate_square_subsequent_mask(seq_tensor):
     """
     生成decoder的上三角矩阵
@@ -690,6 +702,7 @@ class DataModule(pl.LightningDataModule):
             shuffle=True,
             pin_memory=self.config.dataloader_pin_memory,
             num_workers=self.config.dataloader_num_workers,
+            persistent_workers=self.config.dataloader_num_workers > 0,
             collate_fn=self.collate_fn,
         )
 
@@ -700,6 +713,7 @@ class DataModule(pl.LightningDataModule):
             shuffle=True,
             pin_memory=self.config.dataloader_pin_memory,
             num_workers=self.config.dataloader_num_workers,
+            persistent_workers=self.config.dataloader_num_workers > 0,
             collate_fn=self.collate_fn,
         )
 
@@ -1,3 +1,6 @@
+import functools
+import itertools
+import os
 import gensim.downloader as api
 import numpy as np
 import torch
@@ -7,7 +10,8 @@ from nltk import word_tokenize
 from nltk.translate.bleu_score import corpus_bleu, sentence_bleu, SmoothingFunction
 from nltk.translate.meteor_score import meteor_score
 from nltk.util import ngrams
-from rouge import Rouge
+from rouge_score.rouge_scorer import RougeScorer
+from scipy.sparse import csr_matrix
 from sacrebleu.metrics import BLEU, CHRF
 from general_files.utils.common_util import (
     print_dict_to_table,
@@ -15,17 +19,26 @@ from general_files.utils.common_util import (
     get_logger,
     print_error_info,
 )
+from general_files.utils.data_util import to_device_tensor
 from statistics import mean
 from sklearn.metrics import accuracy_score
 import re
 import string
 from collections import Counter
-from bert_score import score
+from concurrent.futures import ProcessPoolExecutor
+from bert_score import BERTScorer
 from general_files.utils.others.q_squared.cal_q_squared import calc_scores
 from general_files.modules.pipeline import Pipeline
 from general_files.models.hf_custom import ModelNet
 from evaluate import load
 
+try:
+    import numba
+    from numba import types as numba_types
+    from numba.typed import Dict as NumbaDict, List as NumbaList
+except ImportError:
+    numba = None
+
 log = get_logger(__name__)
 
 
@@ -98,42 +111,51 @@ def get_padding_mask(seq, pad_token_id):
         seq_lens:
 
     """
-    ones = torch.ones_like(seq)
-    zeros = torch.zeros_like(seq)
-    mask = torch.where(seq == pad_token_id, zeros, ones)
+    mask = seq.ne(pad_token_id).to(seq.dtype)
     seq_lens = mask.sum(dim=1)
     return mask, seq_lens
 
 
-def get_ppl(df, model, tokenizer):
+def get_ppl(df, model, tokenizer, config):
     loss_dict = df.map(
-        lambda batch: {"loss": compute_loss(batch, model, tokenizer)},
+        lambda batch: compute_loss(batch, model, tokenizer),
         batched=True,
-        batch_size=1,
+        batch_size=config.test_batch_size,
         desc="Compute PPL",
     )
 
-    eval_loss = []
-    for item in list(loss_dict):
-        eval_loss.append(item["loss"])
-    ppl = np.mean(eval_loss)
+    # 按每个样本的有效 token 数加权平均，全部样本都没有有效 token 时退化为直接平均
+    if sum(loss_dict["token_num"]) > 0:
+        ppl = np.average(loss_dict["loss"], weights=loss_dict["token_num"])
+    else:
+        ppl = np.mean(loss_dict["loss"])
     return ppl
 
 
+_BERT_SCORER = None
+
+
+def get_bert_scorer(config):
+    """BERTScorer 只初始化一次，模型常驻显存，避免每次评测都重新加载权重"""
+    global _BERT_SCORER
+    if _BERT_SCORER is None:
+        _BERT_SCORER = BERTScorer(
+            lang="en",
+            rescale_with_baseline=True,
+            device=config.default_device,
+            batch_size=config.get("bert_score_batch_size", 128),
+            nthreads=4,
+        )
+    return _BERT_SCORER
+
+
 def get_bert_score(df, config):
-    # scorer = BertScorer()
-    # scorer.init_scorer(lang='en', num_layers=8, rescale_with_baseline=True)
-    generated = df["generated_seqs"]
+    if "generated_seqs" in df.column_names:
+        generated = df["generated_seqs"]
+    else:
+        generated = df["generated"]
     target = df["bert_score_reference"]
-    # scores = scorer.get_score(target, generated)[-1]
-    scores = score(
-        generated,
-        target,
-        lang="en",
-        verbose=False,
-        rescale_with_baseline=True,
-        device=config.default_device,
-    )[-1].numpy()
+    scores = get_bert_scorer(config).score(generated, target)[-1].numpy()
     return round(mean(list(scores)), 4)
 
 
@@ -150,9 +172,11 @@ def get_q_squared_score(df, config=None):
 
 
 def compute_loss(batch, model, tokenizer):
-    input_ids, labels = torch.LongTensor(batch["input_ids"]).to(
-        model.device
-    ), torch.LongTensor(batch["labels"]).to(model.device)
+    # batch 内各样本长度不一，先分别 pad 到各自的最大长度再转换为 tensor
+    input_ids = tokenizer.pad({"input_ids": batch["input_ids"]})["input_ids"]
+    labels = tokenizer.pad({"labels": batch["labels"]})["labels"]
+    input_ids = to_device_tensor(input_ids, model.device)
+    labels = to_device_tensor(labels, model.device)
     ignore_columns = [
         "source",
         "target",
@@ -170,22 +194,43 @@ def compute_loss(batch, model, tokenizer):
     for k in batch.data.keys():
         if k not in ignore_columns and "decoder_" in k:
             try:
-                other_features[k] = torch.LongTensor(batch[k]).to(model.device)
+                other_features[k] = to_device_tensor(batch[k], model.device)
             except ValueError:
                 other_features[k] = batch[k]
     with torch.no_grad():
         model.stage = "train"
         outputs = model(input_ids=input_ids, labels=labels, **other_features)
-        eval_loss = outputs.lm_loss
+        token_mask = labels.ne(tokenizer.pad_token_id)
+        logits = outputs.get("logits")
+        if logits is not None:
+            # 按样本计算 loss，batch 内不同样本的 ppl 互不影响
+            if not getattr(model.backbone.config, "is_encoder_decoder", True):
+                logits = logits[:, :-1, :]
+                token_mask = token_mask[:, 1:]
+                labels = labels[:, 1:]
+            nll = F.cross_entropy(
+                logits.float().transpose(1, 2), labels, reduction="none"
+            )
+            token_num = token_mask.sum(-1)
+            eval_loss = (nll * token_mask).sum(-1) / token_num.clamp(min=1)
+        else:
+            token_num = token_mask.sum(-1)
+            eval_loss = outputs.lm_loss.expand(labels.size(0))
 
-    return [eval_loss.exp().item()]
+    return {
+        "loss": eval_loss.exp().tolist(),
+        "token_num": token_num.tolist(),
+    }
+
+
+_PUNCT_TBL = str.maketrans("", "", string.punctuation)
+# 一次替换同时去掉冠词等停用词并合并连续空格
+_CLEAN_RE = re.compile(r"(?:\b(?:a|an|the|in|our)\b| )+")
 
 
 def clean_text(text):
-    text = text.lower()
-    text = text.translate(str.maketrans("", "", string.punctuation))
-    text = re.sub(r"\b(a|an|the|in|our)\b", " ", text)
-    return re.sub(" +", " ", text).strip()
+    text = text.lower().translate(_PUNCT_TBL)
+    return _CLEAN_RE.sub(" ", text).strip()
 
 
 def compute_f1(test_df):
@@ -194,16 +239,21 @@ def compute_f1(test_df):
     """
     candidates = test_df["generated_seqs"]
     references = test_df["f1_reference"]
+    gold_toks_list = [clean_text(a_gold).split() for a_gold in references]
+    pred_toks_list = [clean_text(a_pred).split() for a_pred in candidates]
     f1_list = []
-    for i, a_gold in enumerate(references):
-        a_pred = candidates[i]
+    for a_pred, gold_toks, pred_toks in zip(candidates, gold_toks_list, pred_toks_list):
         if a_pred == "":
             f1_list.append(0)
             continue
-        gold_toks = clean_text(a_gold).split()
-        pred_toks = clean_text(a_pred).split()
-        common = Counter(gold_toks) & Counter(pred_toks)
-        num_same = sum(common.values())
+        shorter, longer = Counter(gold_toks), Counter(pred_toks)
+        if len(shorter) > len(longer):
+            shorter, longer = longer, shorter
+        num_same = 0
+        for tok, count in shorter.items():
+            other = longer.get(tok, 0)
+            if other:
+                num_same += min(count, other)
         if num_same == 0:
             f1_list.append(0)
             continue
@@ -224,74 +274,174 @@ def compute_sacre_bleu(references, candidates):
     return round(bleu.corpus_score(candidates, [references]).score, 4)
 
 
-def compute_sent_bleu(references, candidates):
-    bleu1 = 0.0
-    bleu2 = 0.0
-    bleu3 = 0.0
-    bleu4 = 0.0
+def _tokenize_refs_cands(references, candidates):
+    """对参考句与生成句统一分词，供 BLEU、Dist 等指标复用
+
+    Args:
+        references: [str] 或 [[str]]，每条样本可以有多个参考句
+        candidates: [str]
+
+    Returns:
+        ref_list: [[[token]]]
+        dec_list: [[token]]
+    """
     ref_list, dec_list = [], []
     for i in range(len(candidates)):
         dec_list.append(word_tokenize(candidates[i]))
         if type(references[i]) is list:
-            tmp = []
-            for ref in references[i]:
-                tmp.append(word_tokenize(ref))
-            ref_list.append(tmp)
+            ref_list.append([word_tokenize(ref) for ref in references[i]])
         else:
             ref_list.append([word_tokenize(references[i])])
+    return ref_list, dec_list
 
-    for example_id, (label, pred) in enumerate(zip(ref_list, dec_list)):
-        bleu1 += sentence_bleu(
-            label,
-            pred,
-            weights=[1, 0, 0, 0],
-            smoothing_function=SmoothingFunction().method3,
-        )
-        bleu2 += sentence_bleu(
-            label,
-            pred,
-            weights=[0.5, 0.5, 0, 0],
-            smoothing_function=SmoothingFunction().method3,
-        )
-        bleu3 += sentence_bleu(
-            label,
-            pred,
-            weights=[1 / 3, 1 / 3, 1 / 3, 0],
-            smoothing_function=SmoothingFunction().method3,
-        )
-        bleu4 += sentence_bleu(
-            label,
-            pred,
-            weights=[0.25, 0.25, 0.25, 0.25],
-            smoothing_function=SmoothingFunction().method3,
-        )
-    bleu1 = bleu1 / len(ref_list)
-    bleu2 = bleu2 / len(ref_list)
-    bleu3 = bleu3 / len(ref_list)
-    bleu4 = bleu4 / len(ref_list)
-    return (
-        round(bleu1 * 100, 4),
-        round(bleu2 * 100, 4),
-        round(bleu3 * 100, 4),
-        round(bleu4 * 100, 4),
+
+# n-gram 滚动哈希所用的基数与掩码
+_NGRAM_HASH_BASE = 1000003
+_NGRAM_HASH_MASK = (1 << 63) - 1
+
+
+def _encode_tokens(tokens, vocab):
+    """将 token 序列编码为 int64 id 数组，vocab 在多次调用间共享并按需扩充"""
+    return np.array(
+        [vocab.setdefault(token, len(vocab)) for token in tokens], dtype=np.int64
     )
 
 
-def compute_corpus_bleu(references, candidates):
-    bleu1 = 0.0
-    bleu2 = 0.0
-    bleu3 = 0.0
-    bleu4 = 0.0
-    ref_list, dec_list = [], []
-    for i in range(len(candidates)):
-        dec_list.append(word_tokenize(candidates[i]))
-        if type(references[i]) is list:
-            tmp = []
-            for ref in references[i]:
-                tmp.append(word_tokenize(ref))
-            ref_list.append(tmp)
-        else:
-            ref_list.append([word_tokenize(references[i])])
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _count_hashed_ngrams(tokens, n):
+        counts = NumbaDict.empty(key_type=numba_types.int64, value_type=numba_types.int64)
+        for start in range(tokens.shape[0] - n + 1):
+            h = 0
+            for k in range(start, start + n):
+                h = h * _NGRAM_HASH_BASE + tokens[k]
+            counts[h] = counts.get(h, 0) + 1
+        return counts
+
+    @numba.njit(cache=True)
+    def _sent_bleu_kernel(hyps, refs, ref_offsets):
+        """一次遍历同时计算 BLEU-1~4，与 nltk 的 sentence_bleu + method3 平滑保持一致
+
+        Args:
+            hyps: typed.List[int64 array]，每条样本的生成句
+            refs: typed.List[int64 array]，所有样本的参考句拼接而成
+            ref_offsets: int64 array[N + 1]，第 i 条样本的参考句为 refs[ref_offsets[i]:ref_offsets[i + 1]]
+
+        Returns:
+            scores: float64 array[N, 4]
+        """
+        n_examples = len(hyps)
+        scores = np.zeros((n_examples, 4))
+        numerators = np.zeros(4)
+        denominators = np.zeros(4)
+        log_p = np.zeros(4)
+        for i in range(n_examples):
+            hyp = hyps[i]
+            hyp_len = hyp.shape[0]
+            closest_ref_len = 0
+            closest_diff = -1
+            for r in range(ref_offsets[i], ref_offsets[i + 1]):
+                ref_len = refs[r].shape[0]
+                diff = abs(ref_len - hyp_len)
+                if closest_diff < 0 or diff < closest_diff or (
+                    diff == closest_diff and ref_len < closest_ref_len
+                ):
+                    closest_diff = diff
+                    closest_ref_len = ref_len
+
+            for n in range(1, 5):
+                hyp_counts = _count_hashed_ngrams(hyp, n)
+                max_ref_counts = NumbaDict.empty(
+                    key_type=numba_types.int64, value_type=numba_types.int64
+                )
+                for r in range(ref_offsets[i], ref_offsets[i + 1]):
+                    ref_counts = _count_hashed_ngrams(refs[r], n)
+                    for h, c in ref_counts.items():
+                        if h in hyp_counts and c > max_ref_counts.get(h, 0):
+                            max_ref_counts[h] = c
+                clipped = 0
+                for h, c in hyp_counts.items():
+                    clipped += min(c, max_ref_counts.get(h, 0))
+                numerators[n - 1] = clipped
+                denominators[n - 1] = max(1, hyp_len - n + 1)
+
+            # 没有任何 unigram 命中时 nltk 直接返回 0
+            if numerators[0] == 0:
+                continue
+
+            if hyp_len > closest_ref_len:
+                bp = 1.0
+            else:
+                bp = np.exp(1 - closest_ref_len / hyp_len)
+
+            # SmoothingFunction().method3
+            incvnt = 1
+            for k in range(4):
+                if numerators[k] == 0:
+                    log_p[k] = -np.log(2.0 ** incvnt * denominators[k])
+                    incvnt += 1
+                else:
+                    log_p[k] = np.log(numerators[k] / denominators[k])
+
+            cumulative = 0.0
+            for k in range(4):
+                cumulative += log_p[k]
+                scores[i, k] = bp * np.exp(cumulative / (k + 1))
+        return scores
+
+
+def _sent_bleu_numba(ref_list, dec_list):
+    """将分词结果编码为整数 id 后交给 _sent_bleu_kernel 计算，返回 [N, 4] 的 BLEU-1~4"""
+    vocab = {}
+    hyps = NumbaList.empty_list(numba_types.int64[:])
+    refs = NumbaList.empty_list(numba_types.int64[:])
+    ref_offsets = np.zeros(len(dec_list) + 1, dtype=np.int64)
+    for i, (label, pred) in enumerate(zip(ref_list, dec_list)):
+        hyps.append(_encode_tokens(pred, vocab))
+        for ref in label:
+            refs.append(_encode_tokens(ref, vocab))
+        ref_offsets[i + 1] = len(refs)
+    return _sent_bleu_kernel(hyps, refs, ref_offsets)
+
+
+if numba is not None:
+    # 导入时先编译一次，避免第一次评测时才支付 JIT 的开销
+    _sent_bleu_numba([[["warm", "up"]]], [["warm", "up"]])
+
+
+# SmoothingFunction 无状态，构建一次即可
+_SMOOTH3 = SmoothingFunction().method3
+
+
+def compute_sent_bleu(references, candidates, tokenized=None):
+    if tokenized is None:
+        tokenized = _tokenize_refs_cands(references, candidates)
+    ref_list, dec_list = tokenized
+
+    if numba is not None:
+        scores = _sent_bleu_numba(ref_list, dec_list)
+        return tuple(round(float(b), 4) for b in scores.mean(axis=0) * 100)
+
+    weights = (
+        [1, 0, 0, 0],
+        [0.5, 0.5, 0, 0],
+        [1 / 3, 1 / 3, 1 / 3, 0],
+        [0.25, 0.25, 0.25, 0.25],
+    )
+    scores = np.empty((4, len(ref_list)), dtype=np.float64)
+    for example_id, (label, pred) in enumerate(zip(ref_list, dec_list)):
+        for n, weight in enumerate(weights):
+            scores[n, example_id] = sentence_bleu(
+                label, pred, weights=weight, smoothing_function=_SMOOTH3
+            )
+    return tuple(round(float(b), 4) for b in scores.mean(axis=1) * 100)
+
+
+def compute_corpus_bleu(references, candidates, tokenized=None):
+    if tokenized is None:
+        tokenized = _tokenize_refs_cands(references, candidates)
+    ref_list, dec_list = tokenized
     bleu1 = corpus_bleu(ref_list, dec_list, weights=(1, 0, 0, 0))
     bleu2 = corpus_bleu(ref_list, dec_list, weights=(0, 1, 0, 0))
     bleu3 = corpus_bleu(ref_list, dec_list, weights=(0, 0, 1, 0))
@@ -304,26 +454,63 @@ def compute_corpus_bleu(references, candidates):
     )
 
 
+# 样本数少于该值时串行计算 meteor / rouge，避免进程池的启动开销
+_PARALLEL_MIN_SIZE = 128
+
+
+def _meteor_one(args):
+    ref_list, candidate = args
+    ref = [r.split(" ") for r in ref_list]
+    cand = candidate.split(" ")
+    return meteor_score(ref, cand)
+
+
 def compute_meteor(references, candidates):
-    score_list = []
+    args = []
     for i in range(len(candidates)):
         if type(references[i]) is list:
             ref_list = references[i]
         else:
             ref_list = [references[i]]
-        ref = [r.split(" ") for r in ref_list]
-        cand = candidates[i].split(" ")
-        score = meteor_score(ref, cand)
-        score_list.append(score)
+        args.append((ref_list, candidates[i]))
+    if len(args) < _PARALLEL_MIN_SIZE:
+        score_list = [_meteor_one(arg) for arg in args]
+    else:
+        # meteor 需要逐词查询 WordNet，纯 CPU 计算，按样本分块多进程并行
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            score_list = list(executor.map(_meteor_one, args, chunksize=64))
     return round(np.mean(score_list), 4)
 
 
+_ROUGE_SCORER = None
+
+
+def get_rouge_scorer():
+    """rouge_score 的 LCS 实现比 rouge 包快得多，scorer 每个进程只构建一次"""
+    global _ROUGE_SCORER
+    if _ROUGE_SCORER is None:
+        _ROUGE_SCORER = RougeScorer(["rouge1", "rouge2", "rougeL"], use_stemmer=True)
+    return _ROUGE_SCORER
+
+
+def _rouge_one(args):
+    reference, candidate = args
+    scores = get_rouge_scorer().score(reference, candidate)
+    return (
+        scores["rouge1"].fmeasure * 100,
+        scores["rouge2"].fmeasure * 100,
+        scores["rougeL"].fmeasure * 100,
+    )
+
+
 def compute_rouge(references, candidates):
-    rouge = Rouge()
-    scores = rouge.get_scores(candidates, references)
-    rouge_1 = [score["rouge-1"]["f"] * 100 for score in scores]
-    rouge_2 = [score["rouge-2"]["f"] * 100 for score in scores]
-    rouge_l = [score["rouge-l"]["f"] * 100 for score in scores]
+    args = list(zip(references, candidates))
+    if len(args) < _PARALLEL_MIN_SIZE:
+        scores = [_rouge_one(arg) for arg in args]
+    else:
+        with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+            scores = list(executor.map(_rouge_one, args, chunksize=64))
+    rouge_1, rouge_2, rouge_l = zip(*scores)
     return (
         round(np.mean(rouge_1), 4),
         round(np.mean(rouge_2), 4),
@@ -331,12 +518,46 @@ def compute_rouge(references, candidates):
     )
 
 
-def distinct_ngram(candidates, n=2):
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _distinct_ngram_kernel(candidates, n):
+        """滚动哈希统计所有生成句中的 n-gram，返回 (不同 n-gram 数, n-gram 总数)"""
+        counts = NumbaDict.empty(key_type=numba_types.int64, value_type=numba_types.int64)
+        total = 0
+        high = 1
+        for _ in range(n):
+            high *= _NGRAM_HASH_BASE
+        for tokens in candidates:
+            h = 0
+            for i in range(tokens.shape[0]):
+                h = h * _NGRAM_HASH_BASE + tokens[i]
+                if i >= n:
+                    h -= tokens[i - n] * high
+                if i >= n - 1:
+                    key = h & _NGRAM_HASH_MASK
+                    counts[key] = counts.get(key, 0) + 1
+                    total += 1
+        return len(counts), total
+
+
+def distinct_ngram(candidates, n=2, tokenized_candidates=None):
     """Return basic ngram statistics, as well as a dict of all ngrams and their freqsuencies."""
+    if tokenized_candidates is None:
+        tokenized_candidates = [word_tokenize(candidate) for candidate in candidates]
+    if numba is not None:
+        vocab = {}
+        encoded = NumbaList.empty_list(numba_types.int64[:])
+        for candidate_tokens in tokenized_candidates:
+            encoded.append(_encode_tokens(candidate_tokens, vocab))
+        uniq_len, ngram_len = _distinct_ngram_kernel(encoded, n)
+        distinct_ngram = uniq_len / ngram_len if ngram_len > 0 else 0
+        return round(distinct_ngram, 4)
+
     ngram_freqs = {}  # ngrams with frequencies
     ngram_len = 0  # total number of ngrams
-    for candidate in candidates:
-        for ngram in ngrams(word_tokenize(candidate), n):
+    for candidate_tokens in tokenized_candidates:
+        for ngram in ngrams(candidate_tokens, n):
             ngram_freqs[ngram] = ngram_freqs.get(ngram, 0) + 1
             ngram_len += 1
     # number of unique ngrams
@@ -345,6 +566,30 @@ def distinct_ngram(candidates, n=2):
     return round(distinct_ngram, 4)
 
 
+if numba is not None:
+    distinct_ngram(None, tokenized_candidates=[["warm", "up"]])
+
+
+@functools.lru_cache(maxsize=4)
+def _load_stopwords(work_dir):
+    with open(f"{work_dir}/data/stopwords.txt") as f:
+        return frozenset(line.strip() for line in f)
+
+
+_GLOVE = None
+_GLOVE_VOCAB = None
+
+
+def _load_glove():
+    """词向量只加载一次，并缓存词表集合用于 O(1) 的成员判断"""
+    global _GLOVE, _GLOVE_VOCAB
+    if _GLOVE is None:
+        # load pre-trained word-vectors from gensim-data
+        _GLOVE = api.load("glove-wiki-gigaword-100")
+        _GLOVE_VOCAB = set(_GLOVE.key_to_index.keys())
+    return _GLOVE, _GLOVE_VOCAB
+
+
 def knowledge_f1(references, candidates, work_dir):
     """
     This function is copied from: https://github.com/PaddlePaddle/Research/blob/master/NLP/Dialogue-PLATO/tools/knowledge_f1.py
@@ -353,11 +598,7 @@ def knowledge_f1(references, candidates, work_dir):
     res = 0.0
     r = 0.0
     p = 0.0
-    stopwords = set()
-    with open(f"{work_dir}/data/stopwords.txt") as f:
-        for line in f:
-            word = line.strip()
-            stopwords.add(word)
+    stopwords = _load_stopwords(work_dir)
 
     for candidate, reference in zip(candidates, references):
         cnt += 1
@@ -365,17 +606,10 @@ def knowledge_f1(references, candidates, work_dir):
             reference = reference[0]
         knowledges = reference.strip().split("\t")
 
-        words = set()
-        for sent in knowledges:
-            for word in sent.split():
-                words.add(word.lower())
-        words = words - stopwords
+        words = {word.lower() for sent in knowledges for word in sent.split()} - stopwords
         k_len = len(words)
 
-        pred = set()
-        for word in candidate.split():
-            pred.add(word.lower())
-        pred = pred - stopwords
+        pred = {word.lower() for word in candidate.split()} - stopwords
         pred_len = len(pred)
         overlap = len(words & pred)
 
@@ -394,38 +628,42 @@ def knowledge_f1(references, candidates, work_dir):
 
 
 def compute_cos_sim(references, candidates, work_dir):
-    # load pre-trained word-vectors from gensim-data
-    word_vectors = api.load("glove-wiki-gigaword-100")
-    vocab_list = word_vectors.index_to_key
+    word_vectors, vocab = _load_glove()
+    key_to_index = word_vectors.key_to_index
 
-    stopwords = set()
-    with open(f"{work_dir}/data/stopwords.txt") as f:
-        for line in f:
-            word = line.strip()
-            stopwords.add(word)
+    stopwords = _load_stopwords(work_dir)
 
-    sim_list = []
+    def to_indices(sent):
+        words = {word.lower() for word in word_tokenize(sent)}
+        return [key_to_index[w] for w in words if w in vocab and w not in stopwords]
+
+    dec_rows, ref_rows = [], []
     for i in range(len(candidates)):
-        dec_set = set()
-        for word in word_tokenize(candidates[i]):
-            word = word.lower()
-            if word in vocab_list:
-                dec_set.add(word)
-        dec_set = dec_set - stopwords
-        dec_list = list(dec_set)
-        if len(dec_list) == 0:
+        dec_indices = to_indices(candidates[i])
+        if len(dec_indices) == 0:
+            continue
+        ref_indices = to_indices(references[i])
+        if len(ref_indices) == 0:
             continue
+        dec_rows.append(dec_indices)
+        ref_rows.append(ref_indices)
+
+    def mean_unit_vectors(rows):
+        # 用 [样本数, 词表大小] 的稀疏 0/1 矩阵乘词向量矩阵，一次求出所有样本的平均词向量
+        indptr = np.cumsum([0] + [len(r) for r in rows])
+        indices = np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64)
+        incidence = csr_matrix(
+            (np.ones(len(indices), dtype=np.float32), indices, indptr),
+            shape=(len(rows), word_vectors.vectors.shape[0]),
+        )
+        means = (incidence @ word_vectors.vectors) / np.diff(indptr)[:, None]
+        return means / np.linalg.norm(means, axis=1, keepdims=True)
 
-        ref_set = set()
-        for word in word_tokenize(references[i]):
-            word = word.lower()
-            if word in vocab_list:
-                ref_set.add(word)
-        ref_set = ref_set - stopwords
-        ref_list = list(ref_set)
-        # compute cosine similarity between two sets of docvecs from the trained set
-        cos_sim = word_vectors.n_similarity(dec_list, ref_list)
-        sim_list.append(cos_sim)
+    # compute cosine similarity between two sets of docvecs from the trained set
+    if dec_rows:
+        sim_list = (mean_unit_vectors(dec_rows) * mean_unit_vectors(ref_rows)).sum(axis=1)
+    else:
+        sim_list = []
 
     avg_sim = np.mean(sim_list)
     cos_similarity = round(avg_sim, 4)
@@ -436,6 +674,14 @@ def compute_cls_acc(references, candidates):
     return accuracy_score(references, candidates)
 
 
+@functools.lru_cache(maxsize=None)
+def _get_metric(name, module_type=None):
+    """evaluate 的评测模块只加载一次，多次调用 get_eval_metrics 时复用"""
+    if module_type is None:
+        return load(name)
+    return load(name, module_type=module_type)
+
+
 def get_eval_metrics(test_df, config, tokenizer):
     """
     评价指标计算
@@ -477,7 +723,7 @@ def get_eval_metrics(test_df, config, tokenizer):
     ###############################################
     if "ppl" in eval_metrics:
         log.info("计算 PPL ing...")
-        perplexity = load("perplexity", module_type="metric")
+        perplexity = _get_metric("perplexity", module_type="metric")
         try:
             ppl = perplexity.compute(predictions=generated_seqs, model_id="gpt2")[
                 "mean_perplexity"
@@ -486,7 +732,7 @@ def get_eval_metrics(test_df, config, tokenizer):
             log.error("计算 PPL 失败")
             print_error_info(e)
             ppl = 9999
-        # ppl = get_ppl(test_df, model, tokenizer)
+        # ppl = get_ppl(test_df, model, tokenizer, config)
         ppl = round(ppl, 4)
         test_result.add(ppl=ppl)
         log.info(f"PPL = {str(ppl)}")
@@ -505,7 +751,7 @@ def get_eval_metrics(test_df, config, tokenizer):
     ###############################################
     if "google_bleu" in eval_metrics:
         log.info("计算 google_bleu ing...")
-        google_bleu = load("google_bleu")
+        google_bleu = _get_metric("google_bleu")
         try:
             google_bleu_score = google_bleu.compute(
                 predictions=generated_seqs, references=reference
@@ -528,11 +774,20 @@ def get_eval_metrics(test_df, config, tokenizer):
         test_result.add(sacrebleu=bleu)
         log.info(f"sacrebleu = {str(bleu)}")
 
+    ###############################################
+    # 统一分词，供 sent_bleu、corpus_bleu、Dist 复用
+    ###############################################
+    tokenized = None
+    if {"sent_bleu", "corpus_bleu", "dist"} & set(eval_metrics):
+        tokenized = _tokenize_refs_cands(reference, generated_seqs)
+
     ###############################################
     # 计算 sent_bleu
     ###############################################
     if "sent_bleu" in eval_metrics:
-        bleu1, bleu2, bleu3, bleu4 = compute_sent_bleu(reference, generated_seqs)
+        bleu1, bleu2, bleu3, bleu4 = compute_sent_bleu(
+            reference, generated_seqs, tokenized=tokenized
+        )
         test_result.add(
             sent_bleu1=bleu1,
             sent_bleu2=bleu2,
@@ -548,7 +803,9 @@ def get_eval_metrics(test_df, config, tokenizer):
     # 计算 corpus_bleu
     ###############################################
     if "corpus_bleu" in eval_metrics:
-        bleu1, bleu2, bleu3, bleu4 = compute_corpus_bleu(reference, generated_seqs)
+        bleu1, bleu2, bleu3, bleu4 = compute_corpus_bleu(
+            reference, generated_seqs, tokenized=tokenized
+        )
         test_result.add(
             corpus_bleu1=bleu1,
             corpus_bleu2=bleu2,
@@ -565,8 +822,8 @@ def get_eval_metrics(test_df, config, tokenizer):
     ###############################################
     if "dist" in eval_metrics:
         log.info("计算 Dist ing...")
-        dist1 = distinct_ngram(generated_seqs, n=1)
-        dist2 = distinct_ngram(generated_seqs, n=2)
+        dist1 = distinct_ngram(generated_seqs, n=1, tokenized_candidates=tokenized[1])
+        dist2 = distinct_ngram(generated_seqs, n=2, tokenized_candidates=tokenized[1])
         test_result.add(
             dist1=dist1,
             dist2=dist2,
@@ -579,7 +836,7 @@ def get_eval_metrics(test_df, config, tokenizer):
     ###############################################
     if "meteor" in eval_metrics:
         log.info("计算 Meteor ing...")
-        meteor = load('meteor')
+        meteor = _get_metric("meteor")
         meteor_score = meteor.compute(predictions=generated_seqs, references=reference)['meteor']
         meteor_score = round(meteor_score, 4)
         # meteor_score = compute_meteor(reference, generated_seqs)
@@ -601,7 +858,7 @@ def get_eval_metrics(test_df, config, tokenizer):
     if "rouge" in eval_metrics:
         log.info("计算 ROUGE ing...")
         try:
-            rouge = load('rouge')
+            rouge = _get_metric("rouge")
             
             rouge_results = rouge.compute(predictions=generated_seqs,
                         references=reference)
@@ -633,12 +890,7 @@ def get_eval_metrics(test_df, config, tokenizer):
         log.info("计算 Bert score ing...")
         
         try:
-            # scores = get_bert_score(test_df, config)
-            # test_result.add(bert_score=scores)
-            bertscore = load("bertscore")
-            bert_score_reference = test_df["bert_score_reference"]           
-            bert_score = mean(bertscore.compute(predictions=generated_seqs, references=bert_score_reference, lang="en", rescale_with_baseline=True)['f1'])
-            bert_score = round(bert_score, 4)
+            bert_score = get_bert_score(test_df, config)
             test_result.add(bert_score=bert_score)
             log.info(f"bert_score = {str(bert_score)}")
         except ValueError:
@@ -666,7 +918,7 @@ def get_eval_metrics(test_df, config, tokenizer):
     if "cls_acc" in eval_metrics:
         log.info("计算 分类 Accuracy ing...")
         try:
-            accuracy_metric = load("accuracy")
+            accuracy_metric = _get_metric("accuracy")
             cls_acc = accuracy_metric.compute(
                 references=reference, predictions=generated_seqs
             )["accuracy"]
@@ -710,6 +962,10 @@ def pack_result_to_seq2seq_lmoutput(result):
     )
 
 
+# 生成时每隔多少步检查一次是否所有句子都已生成 eos
+_EOS_CHECK_INTERVAL = 4
+
+
 def nucleus_generate(
     input_ids: torch.Tensor,
     decoder_input_ids: torch.Tensor,
@@ -719,12 +975,40 @@ def nucleus_generate(
     top_k: int = 0,
     top_p: float = 0.7,
     model=None,
+    use_cache: bool = True,
     **other_features,
 ):
-    generated_ids = None
+    batch_size = input_ids.size(0)
+    # 预先分配生成结果与输入的缓冲区，每步只写入新的 token，避免反复 torch.cat
+    generated_ids = torch.full(
+        (batch_size, max_length),
+        decoder_eos_token_id,
+        dtype=torch.long,
+        device=input_ids.device,
+    )
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+    # 记录每一步结束后是否所有句子都已生成 eos，用于最后截断
+    all_finished = torch.zeros(max_length, dtype=torch.bool, device=input_ids.device)
+    prefix = decoder_input_ids if decoder_input_ids is not None else input_ids
+    prefix_len = prefix.size(-1)
+    input_buffer = prefix.new_full((batch_size, prefix_len + max_length), decoder_eos_token_id)
+    input_buffer[:, :prefix_len] = prefix
+    cur_len = 0
     past_result = None
     for i in range(max_length):
-        past_result = model(input_ids, decoder_input_ids, past_result, **other_features)
+        # past_result 中缓存了前缀的 key/value，ModelNet 只需编码最新的 token
+        past_result = past_result if use_cache else None
+        if decoder_input_ids is not None:
+            decoder_input_ids = input_buffer[:, : prefix_len + cur_len]
+            past_result = model(
+                input_ids,
+                decoder_input_ids=decoder_input_ids,
+                past_result=past_result,
+                **other_features,
+            )
+        else:
+            input_ids = input_buffer[:, : prefix_len + cur_len]
+            past_result = model(input_ids, past_result=past_result, **other_features)
         logits = past_result["logits"][:, -1, :]
         logits = logits / temperature
 
@@ -732,26 +1016,22 @@ def nucleus_generate(
         probabilities = F.softmax(filtered_logits, dim=-1)
 
         next_token = torch.multinomial(probabilities, 1)
-        pred_index = next_token.detach().cpu()
-
-        if (pred_index == decoder_eos_token_id).int().sum() == len(pred_index):
+        pred_index = next_token.detach().squeeze(-1)
+
+        # 已经生成 eos 的句子不再更新，后续位置保持为 eos
+        pred_index = pred_index.masked_fill(finished, decoder_eos_token_id)
+        finished |= pred_index == decoder_eos_token_id
+        generated_ids[:, cur_len] = pred_index
+        input_buffer[:, prefix_len + cur_len] = pred_index.to(input_buffer.device)
+        all_finished[cur_len] = finished.all()
+        cur_len += 1
+        # 判断是否全部结束需要与 GPU 同步，因此每隔几步才检查一次
+        if cur_len % _EOS_CHECK_INTERVAL == 0 and finished.all():
             break
-        generated_ids = (
-            torch.cat([generated_ids, pred_index], dim=-1)
-            if generated_ids is not None
-            else pred_index
-        )
-        if decoder_input_ids is not None:
-            decoder_input_ids = torch.cat(
-                [decoder_input_ids, pred_index.to(decoder_input_ids.device)], dim=-1
-            )
-        else:
-            input_ids = torch.cat([input_ids, pred_index.to(input_ids.device)], dim=-1)
-    for i, s in enumerate(generated_ids):
-        ss = s.tolist()
-        if decoder_eos_token_id in ss:
-            generated_ids[i][ss.index(decoder_eos_token_id) :] = decoder_eos_token_id
-    return generated_ids.tolist()
+    # 截断到第一个所有句子都已结束的步（含该步），每个句子都恰好保留结尾的 eos
+    all_finished = all_finished[:cur_len]
+    end = int(all_finished.int().argmax()) + 1 if all_finished.any() else cur_len
+    return generated_ids[:, :end].cpu().tolist()
 
 
 def greedy_generate(
@@ -760,66 +1040,99 @@ def greedy_generate(
     decoder_eos_token_id: int,
     max_length: int = 100,
     model=None,
+    use_cache: bool = True,
     **other_features,
 ):
-    generated_ids = None
+    batch_size = input_ids.size(0)
+    # 预先分配生成结果与输入的缓冲区，每步只写入新的 token，避免反复 torch.cat
+    generated_ids = torch.full(
+        (batch_size, max_length),
+        decoder_eos_token_id,
+        dtype=torch.long,
+        device=input_ids.device,
+    )
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+    # 记录每一步结束后是否所有句子都已生成 eos，用于最后截断
+    all_finished = torch.zeros(max_length, dtype=torch.bool, device=input_ids.device)
+    prefix = decoder_input_ids if decoder_input_ids is not None else input_ids
+    prefix_len = prefix.size(-1)
+    input_buffer = prefix.new_full((batch_size, prefix_len + max_length), decoder_eos_token_id)
+    input_buffer[:, :prefix_len] = prefix
+    cur_len = 0
     past_result = None
-    softmax = torch.nn.Softmax(dim=-1)
     for _ in range(max_length):
-        past_result = model(input_ids, decoder_input_ids, past_result, **other_features)
-        probabilities = softmax(past_result["logits"][:, -1, :])
-        next_token = torch.multinomial(probabilities, 1)
-        pred_index = next_token.detach().cpu()
-        if (pred_index == decoder_eos_token_id).int().sum() == len(pred_index):
-            break
-        generated_ids = (
-            torch.cat([generated_ids, pred_index], dim=-1)
-            if generated_ids is not None
-            else pred_index
-        )
+        # past_result 中缓存了前缀的 key/value，ModelNet 只需编码最新的 token
+        past_result = past_result if use_cache else None
         if decoder_input_ids is not None:
-            decoder_input_ids = torch.cat(
-                [decoder_input_ids, pred_index.to(decoder_input_ids.device)], dim=-1
+            decoder_input_ids = input_buffer[:, : prefix_len + cur_len]
+            past_result = model(
+                input_ids,
+                decoder_input_ids=decoder_input_ids,
+                past_result=past_result,
+                **other_features,
             )
         else:
-            input_ids = torch.cat([input_ids, pred_index.to(input_ids.device)], dim=-1)
-    for i, s in enumerate(generated_ids):
-        ss = s.tolist()
-        if decoder_eos_token_id in ss:
-            generated_ids[i][ss.index(decoder_eos_token_id) :] = decoder_eos_token_id
-    return generated_ids.tolist()
+            input_ids = input_buffer[:, : prefix_len + cur_len]
+            past_result = model(input_ids, past_result=past_result, **other_features)
+        # 贪心解码直接取概率最大的 token，无需 softmax 与采样
+        pred_index = past_result["logits"][:, -1, :].argmax(dim=-1).detach()
+
+        # 已经生成 eos 的句子不再更新，后续位置保持为 eos
+        pred_index = pred_index.masked_fill(finished, decoder_eos_token_id)
+        finished |= pred_index == decoder_eos_token_id
+        generated_ids[:, cur_len] = pred_index
+        input_buffer[:, prefix_len + cur_len] = pred_index.to(input_buffer.device)
+        all_finished[cur_len] = finished.all()
+        cur_len += 1
+        # 判断是否全部结束需要与 GPU 同步，因此每隔几步才检查一次
+        if cur_len % _EOS_CHECK_INTERVAL == 0 and finished.all():
+            break
+    # 截断到第一个所有句子都已结束的步（含该步），每个句子都恰好保留结尾的 eos
+    all_finished = all_finished[:cur_len]
+    end = int(all_finished.int().argmax()) + 1 if all_finished.any() else cur_len
+    return generated_ids[:, :end].cpu().tolist()
 
 
 def top_k_top_p_filtering(
     batch_logits, top_k=10, top_p=0.9, filter_value=-10000.0
 ) -> torch.tensor:
     assert batch_logits.dim() == 2
-    for index in range(batch_logits.shape[0]):
-        logits = batch_logits[index]
-        top_k = min(top_k, logits.size(-1))
-        if top_k > 0:
-            indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-            logits[indices_to_remove] = filter_value
-
-        if top_p > 0.0:
-            sorted_logits, sorted_indices = torch.sort(logits, descending=True)
-            cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
-
-            sorted_indices_to_remove = cumulative_probs > top_p
-            sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[
-                ..., :-1
-            ].clone()
-            sorted_indices_to_remove[..., 0] = 0
-
-            indices_to_remove = sorted_indices[sorted_indices_to_remove]
-            logits[indices_to_remove] = filter_value
-            batch_logits[index] = logits
+    # top_k 不小于词表大小或 top_p 不小于 1 时过滤不起作用，直接跳过对应的 topk / sort
+    if 0 < top_k < batch_logits.size(-1):
+        kth_logits = torch.topk(batch_logits, top_k, dim=-1)[0][..., -1:]
+        batch_logits.masked_fill_(batch_logits < kth_logits, filter_value)
+
+    if 0.0 < top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(batch_logits, descending=True, dim=-1)
+        cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
+
+        sorted_indices_to_remove = cumulative_probs > top_p
+        sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
+        sorted_indices_to_remove[..., 0] = 0
+
+        # 将排序后的 mask 映射回原始词表位置
+        indices_to_remove = sorted_indices_to_remove.scatter(
+            -1, sorted_indices, sorted_indices_to_remove
+        )
+        batch_logits.masked_fill_(indices_to_remove, filter_value)
     return batch_logits
 
 
 def generate_sentences(model, batch, tokenizer, config):
-    input_ids = torch.LongTensor(batch["input_ids"]).to(model.device)
+    # 分类任务不需要自回归生成，直接预测标签
+    if config.data_mode == "classification":
+        return predict_labels(model, batch, tokenizer, config)
+    input_ids = to_device_tensor(batch["input_ids"], model.device)
     other_features = model.prepare_other_features_for_generation(batch)
+    # 自定义生成方法：encoder-decoder 模型的解码器从 decoder_start_token_id 开始生成，其余模型直接在 input_ids 后续写
+    backbone_config = getattr(getattr(model, "backbone", None), "config", None)
+    if getattr(backbone_config, "is_encoder_decoder", False):
+        decoder_start_token_id = backbone_config.decoder_start_token_id
+        if decoder_start_token_id is None:
+            decoder_start_token_id = tokenizer.bos_token_id
+        decoder_input_ids = input_ids.new_full((input_ids.size(0), 1), decoder_start_token_id)
+    else:
+        decoder_input_ids = None
     if config.data_mode == "unilm":
         max_len = config.max_generation_length + len(input_ids[0])
         min_len = config.min_generation_length + len(input_ids[0])
@@ -834,21 +1147,25 @@ def generate_sentences(model, batch, tokenizer, config):
             # Generate with nucleus search.
             generated_ids = nucleus_generate(
                 input_ids=input_ids,
+                decoder_input_ids=decoder_input_ids,
                 decoder_eos_token_id=tokenizer.eos_token_id,
                 top_k=config.top_k,
                 top_p=config.top_p,
                 temperature=config.temperature,
                 max_length=max_len,
                 model=model,
+                use_cache=config.get("use_cache", True),
                 **other_features,
             )
         elif config.generate_method == "greedy":
             # Generate with greedy search.
             generated_ids = greedy_generate(
                 input_ids=input_ids,
+                decoder_input_ids=decoder_input_ids,
                 decoder_eos_token_id=tokenizer.eos_token_id,
                 max_length=max_len,
                 model=model,
+                use_cache=config.get("use_cache", True),
                 **other_features,
             )
     else:
@@ -868,7 +1185,7 @@ def generate_sentences(model, batch, tokenizer, config):
                 top_p=config.top_p,
                 max_length=max_len,
                 min_length=min_len,
-                use_cache=True,
+                use_cache=config.get("use_cache", True),
                 repetition_penalty=0.9,
                 early_stopping=True,
                 **other_features,
@@ -878,41 +1195,43 @@ def generate_sentences(model, batch, tokenizer, config):
             # Generate with nucleus search.
             generated_ids = nucleus_generate(
                 input_ids=input_ids,
+                decoder_input_ids=decoder_input_ids,
                 decoder_eos_token_id=tokenizer.eos_token_id,
                 top_k=config.top_k,
                 top_p=config.top_p,
                 temperature=config.temperature,
                 max_length=max_len,
                 model=model,
+                use_cache=config.get("use_cache", True),
                 **other_features,
             )
     # 只取后边的id
     if not generated_ids:
         if config.data_mode == "unilm":
-            generated_ids = [
-                g[len(input_ids[i]) :] for i, g in enumerate(ori_generated_ids)
-            ]
+            # 输入已统一 pad 到相同长度，一次切片即可去掉所有样本的输入部分
+            generated_ids = ori_generated_ids[:, input_ids.size(-1) :]
         else:
             generated_ids = ori_generated_ids
-    if config.data_mode == "classification":
-        return generated_ids
+    seqs = tokenizer.batch_decode(generated_ids, skip_special_tokens=True)
+    seqs_with_special_tokens = tokenizer.batch_decode(
+        generated_ids, skip_special_tokens=False, ignore_tokens=[tokenizer.pad_token]
+    )
     generated_sentences = [
-        {
-            "seqs": tokenizer.decode(sent, skip_special_tokens=True),
-            "seqs_with_special_tokens": tokenizer.decode(
-                sent, skip_special_tokens=False, ignore_tokens=[tokenizer.pad_token]
-            ),
-        }
-        for sent in generated_ids
+        {"seqs": seq, "seqs_with_special_tokens": seq_with_special_tokens}
+        for seq, seq_with_special_tokens in zip(seqs, seqs_with_special_tokens)
     ]
     return generated_sentences
 
 
 def predict_labels(model, batch, tokenizer, config):
     model.eval()
-    input_ids = torch.LongTensor(batch["input_ids"]).to(model.device)
+    input_ids = to_device_tensor(batch["input_ids"], model.device)
     other_features = model.prepare_other_features_for_generation(batch)
-    for key in other_features.keys():
-        other_features[key] = other_features[key].to(model.device)
-    generated_ids = model(input_ids=input_ids, **other_features)["predict_labels"]
-    return generated_ids.cpu().tolist()
+    other_features = {
+        k: v.to(model.device, non_blocking=True) if torch.is_tensor(v) else v
+        for k, v in other_features.items()
+    }
+    with torch.inference_mode():
+        generated_ids = model(input_ids=input_ids, **other_features)["predict_labels"]
+    # 返回 ndarray，由 datasets.map 直接写入 Arrow，无需逐元素转为 Python 对象
+    return generated_ids.detach().cpu().numpy()
@@ -1,91 +1,205 @@
-from datasets import Dataset
+import functools
+import hashlib
+import os
+from datasets import Dataset, concatenate_datasets
+from datasets.fingerprint import Hasher
 import general_files.utils.common_util as utils
 from general_files.utils.data_util import print_dataset_overview
 
+try:
+    import multiprocess
+except ImportError:
+    multiprocess = None
+
 log = utils.get_logger(__name__)
 
 
+# map 期间登记正在编码的 processor，fork 出的子进程直接继承，无需序列化 processor 及其 tokenizer
+_PROCESSOR_REGISTRY = dict()
+
+
+def _start_method_is_fork():
+    # datasets 的多进程 map 基于 multiprocess.Pool
+    if multiprocess is None:
+        return False
+    return multiprocess.get_start_method() == "fork"
+
+
+def _tokenize_stage(batch, stage, processor=None, processor_id=None):
+    # 定义在模块级别，便于 datasets 在多进程 map 时序列化并计算缓存指纹
+    if processor is None:
+        processor = _PROCESSOR_REGISTRY[processor_id]
+    return processor.tokenize_data(batch, stage=stage)
+
+
+def _strip_index(dataset):
+    # 由 pandas 转换而来的数据集会带有多余的 index 字段
+    if '__index_level_0__' in dataset.column_names:
+        dataset = dataset.remove_columns('__index_level_0__')
+    return dataset
+
+
 class BaseProcessor:
+    # 数据集名称 -> public_data_path 下的目录名，未登记的数据集直接使用数据集名称作为目录名
+    _PUBLIC_SUBDIRS = {
+        "wow": "wizard_of_wikipedia",
+        "persona_chat": "persona_chat",
+    }
+
     def __init__(self, config, tokenizer=None, only_test=False):
         self.config = config
         self.tokenizer = tokenizer
         self.only_test = only_test
-        self.dataset_public_path_map = {
-            "wow": f"{config.public_data_path}/wizard_of_wikipedia",
-            "persona_chat": f"{config.public_data_path}/persona_chat",
-        }
         self.public_dataset_path = self.get_public_data_path()
         
     def get_public_data_path(self):
-        return self.dataset_public_path_map[self.config.dataset]
+        subdir = self._PUBLIC_SUBDIRS.get(self.config.dataset, self.config.dataset)
+        return f"{self.config.public_data_path}/{subdir}"
 
     def get_dataset(self):
         """
         """
         if self.only_test:
             self.config.dataset_part = ['test']
-        train_data_tokenized = valid_data_tokenized = test_data_tokenized = None
-        if 'train' in self.config.dataset_part:
-            train_rows = self.read_data(stage='train')
-            train_dataset = Dataset.from_dict(train_rows)
-            log.info("Tokenize Train Dataset...")
-            train_data_tokenized = train_dataset.map(
-                lambda batch: self.tokenize_data(batch, stage='train'),
-                batched=True,
-                desc='Tokenize Train Dataset'
-            )
-            if '__index_level_0__' in train_data_tokenized.column_names:
-                train_data_tokenized = train_data_tokenized.remove_columns('__index_level_0__')
-
-        if 'valid' in self.config.dataset_part:
-            valid_rows = self.read_data(stage='valid')
-            valid_dataset = Dataset.from_dict(valid_rows)
-            log.info("Tokenize Valid Dataset...")
-            valid_data_tokenized = valid_dataset.map(
-                lambda batch: self.tokenize_data(batch, stage='valid'),
-                batched=True,
-                desc='Tokenize Valid Dataset'
-            )
-            if '__index_level_0__' in valid_data_tokenized.column_names:
-                valid_data_tokenized = valid_data_tokenized.remove_columns('__index_level_0__')
-
-        if 'test' in self.config.dataset_part:
-            test_rows = self.read_data(stage='test')
-            test_dataset = Dataset.from_dict(test_rows)
-            log.info("Tokenize Test Dataset...")
-            test_data_tokenized = test_dataset.map(
-                lambda batch: self.tokenize_data(batch, stage='test'),
-                batched=True,
-                desc='Tokenize Test Dataset'
-            )
-            if '__index_level_0__' in test_data_tokenized.column_names:
-                test_data_tokenized = test_data_tokenized.remove_columns('__index_level_0__')
-        columns = list(train_rows.keys()) if train_data_tokenized is not None else None
-        test_columns = list(test_rows.keys()) if test_data_tokenized is not None else None
-        raw_data = (
-            train_data_tokenized.remove_columns(
-                list(set(train_data_tokenized.column_names).difference(set(columns)))) \
-                if train_data_tokenized is not None else None,
-            valid_data_tokenized.remove_columns(
-                list(set(valid_data_tokenized.column_names).difference(set(columns)))) \
-                if valid_data_tokenized is not None else None,
-            test_data_tokenized.remove_columns(
-                list(set(test_data_tokenized.column_names).difference(set(test_columns)))) \
-                if test_data_tokenized is not None else None,
-        )
-        train_data_tokenized = train_data_tokenized.remove_columns(
-            list(set(train_data_tokenized.column_names).intersection(set(columns)))) \
-            if train_data_tokenized is not None else None
-        valid_data_tokenized = valid_data_tokenized.remove_columns(
-            list(set(valid_data_tokenized.column_names).intersection(set(columns)))) \
-            if valid_data_tokenized is not None else None
-        test_data_tokenized = test_data_tokenized.remove_columns(
-            list(set(test_data_tokenized.column_names).intersection(set(test_columns)))) \
-            if test_data_tokenized is not None else None
+        map_batch_size = self.config.get("dataset_map_batch_size", 1000)
+        # from_dict 构建的数据集 map 结果本身就在内存中，该开关实际决定是否将编码结果缓存到磁盘并在下次运行时复用
+        keep_in_memory = self.config.get("in_memory_dataset", True)
+        # transform 模式下训练集与验证集不预先编码，而是在 DataLoader 取数据时才编码
+        # 测试集（以及 bad case 分析时代替测试集的验证集）生成结果需要与原始字段拼接，始终预先编码
+        use_transform = self.config.get("tokenize_mode", "map") == "transform"
+        lazy_stages = set()
+        if use_transform:
+            lazy_stages.add('train')
+            if not self.config.get("eval_bad_case_analysis", False):
+                lazy_stages.add('valid')
+
+        tokenized = {'train': None, 'valid': None, 'test': None}
+        raw = {'train': None, 'valid': None, 'test': None}
+        _PROCESSOR_REGISTRY[id(self)] = self
+        try:
+            for stage in ('train', 'valid', 'test'):
+                if stage not in self.config.dataset_part:
+                    continue
+                dataset = self.build_raw_dataset(stage)
+                if stage in lazy_stages:
+                    # 原始字段保持不变，编码结果只在取数据时产生
+                    raw[stage] = dataset
+                    tokenized[stage] = self.lazy_tokenize(dataset, stage=stage)
+                    continue
+                desc = f'Tokenize {stage.capitalize()} Dataset'
+                log.info(f"{desc}...")
+                num_proc = self.get_num_proc(dataset, map_batch_size)
+                # 只有单进程或 fork 出的子进程能继承登记表，spawn / forkserver 时子进程会重新导入模块，
+                # 此时只能将 processor 序列化后传给子进程
+                if num_proc is None or _start_method_is_fork():
+                    fn_kwargs = {'processor_id': id(self), 'stage': stage}
+                else:
+                    fn_kwargs = {'processor': self, 'stage': stage}
+                cache_file_name = None if keep_in_memory else self.get_cache_file_name(dataset, stage)
+                dataset_tokenized = None
+                if cache_file_name is not None and not self.config.force_reload_data:
+                    dataset_tokenized = self.load_cached_dataset(cache_file_name, num_proc)
+                if dataset_tokenized is None:
+                    dataset_tokenized = dataset.map(
+                        _tokenize_stage,
+                        fn_kwargs=fn_kwargs,
+                        batched=True,
+                        batch_size=map_batch_size,
+                        keep_in_memory=keep_in_memory,
+                        cache_file_name=cache_file_name,
+                        load_from_cache_file=not self.config.force_reload_data,
+                        num_proc=num_proc,
+                        desc=desc
+                    )
+                # 将编码后的数据集拆分为原始字段与编码字段两部分
+                raw[stage], tokenized[stage] = self.split_columns(_strip_index(dataset_tokenized), dataset.column_names)
+        finally:
+            _PROCESSOR_REGISTRY.pop(id(self), None)
 
+        train_data_tokenized, valid_data_tokenized, test_data_tokenized = (
+            tokenized['train'], tokenized['valid'], tokenized['test'])
+        raw_data = (raw['train'], raw['valid'], raw['test'])
         print_dataset_overview(train_data_tokenized, valid_data_tokenized, test_data_tokenized)
         return train_data_tokenized, valid_data_tokenized, test_data_tokenized, raw_data
 
+    def build_raw_dataset(self, stage):
+        """
+        构建未编码的原始数据集
+        """
+        return Dataset.from_dict(self.read_data(stage=stage))
+
+    def split_columns(self, dataset_tokenized, raw_columns):
+        """
+        返回 (只含原始字段的数据集, 只含编码字段的数据集)
+        """
+        raw_columns = frozenset(raw_columns)
+        raw_present = [c for c in dataset_tokenized.column_names if c in raw_columns]
+        derived = [c for c in dataset_tokenized.column_names if c not in raw_columns]
+        return dataset_tokenized.remove_columns(derived), dataset_tokenized.remove_columns(raw_present)
+
+    def lazy_tokenize(self, dataset, stage):
+        """
+        使用 with_transform 在每次取数据时才编码，避免预先把全部编码结果写入 Arrow 缓存
+        注意返回的数据集的 column_names 仍为原始字段
+        """
+        if dataset is None:
+            return None
+        return dataset.with_transform(
+            functools.partial(_tokenize_stage, processor=self, stage=stage)
+        )
+
+    def get_cache_file_name(self, dataset, stage):
+        """
+        根据原始数据、编码函数、分词器与编码相关配置计算稳定的指纹作为编码结果的缓存文件名，
+        重复运行时直接读取缓存，无需重新编码
+        """
+        tokenizer = getattr(self.tokenizer, 'tokenizer', None)
+        fingerprint_fields = [
+            type(self).__module__,
+            type(self).__name__,
+            stage,
+            dataset._fingerprint,
+            # 子类修改编码逻辑或切换数据格式后，缓存随之失效
+            Hasher.hash(type(self).tokenize_data),
+            str(self.config.get('data_mode', '')),
+            str(getattr(tokenizer, 'name_or_path', self.config.pretrain_model)),
+            str(len(self.tokenizer)) if self.tokenizer is not None else '',
+            str(self.config.get('encoder_max_length', '')),
+            str(self.config.get('decoder_max_length', '')),
+            str(self.config.get('sent_max_length', '')),
+        ]
+        fingerprint = hashlib.blake2b('|'.join(fingerprint_fields).encode('utf-8'), digest_size=16).hexdigest()
+        cache_dir = self.config.get('dataset_cache_dir', os.path.join(self.config.cache_dir, 'tokenized_datasets'))
+        os.makedirs(cache_dir, exist_ok=True)
+        return os.path.join(cache_dir, f'{self.config.dataset}_{stage}_{fingerprint}.arrow')
+
+    def load_cached_dataset(self, cache_file_name, num_proc=None):
+        """
+        读取 get_cache_file_name 对应的编码结果，缓存不存在时返回 None
+        from_dict 构建的数据集没有缓存文件，map 不会检查 cache_file_name 是否已存在，因此需要自行读取
+        多进程 map 时每个进程各写一个分片，文件名带有 datasets 默认的 _{rank:05d}_of_{num_proc:05d} 后缀
+        """
+        if num_proc is None:
+            cache_files = [cache_file_name]
+        else:
+            base, ext = os.path.splitext(cache_file_name)
+            cache_files = [f'{base}_{rank:05d}_of_{num_proc:05d}{ext}' for rank in range(num_proc)]
+        if not all(os.path.exists(cache_file) for cache_file in cache_files):
+            return None
+        log.info(f"Load tokenized dataset from {cache_file_name}")
+        return concatenate_datasets([Dataset.from_file(cache_file) for cache_file in cache_files])
+
+    def get_num_proc(self, dataset, map_batch_size):
+        """
+        Dataset.map 使用的进程数，默认单进程，通过 dataset_num_proc 开启多进程
+        进程数不超过数据集的 batch 数，保证每个进程至少处理一个 batch
+        """
+        num_proc = self.config.get("dataset_num_proc", None)
+        if not num_proc:
+            return None
+        num_proc = min(num_proc, len(dataset) // map_batch_size)
+        return num_proc if num_proc > 1 else None
+
     def tokenize_data(self, batch, stage=None):
         pass
 
@@ -105,25 +219,24 @@ class BaseProcessor:
         target: str
         offset_mapping: [tuple(start_offset, end_offset)]
         """
-        start_offsets = []
-        end_offsets = []
-
-        for os in offset_mapping:
-            start_offsets.append(os[0])
-            end_offsets.append(os[1])
+        # offset -> token 下标，起始位置取第一次出现的 token，结束位置取最后一次出现的 token
+        start_to_index = dict()
+        end_to_index = dict()
+        for i, (start_offset, end_offset) in enumerate(offset_mapping):
+            start_to_index.setdefault(start_offset, i)
+            end_to_index[end_offset] = i
         segments_index = []
         for segment in segments:
             start = 0
             while True:
                 start_index = target.find(segment, start)
-                if start_index < 0 or start_index not in start_offsets:
+                if start_index < 0 or start_index not in start_to_index:
                     break
                 end_index = start_index + len(segment)
-                if end_index not in end_offsets:
+                end_offset = end_to_index.get(end_index)
+                if end_offset is None:
                     break
-                start_offset = start_offsets.index(start_index)
-                end_offset = len(end_offsets) - end_offsets[-1::-1].index(end_index) - 1
-                segments_index.append((start_offset, end_offset))
+                segments_index.append((start_to_index[start_index], end_offset))
 
                 start = end_index
 
@@ -19,11 +19,15 @@ from collections import Counter
 from bert_score import score
 
 
+_PUNCT_TBL = str.maketrans('', '', string.punctuation)
+_STOP_RE = re.compile(r'\b(a|an|the|in|our)\b')
+_SPACES_RE = re.compile(' +')
+
+
 def clean_text(text):
-    text = text.lower()
-    text = text.translate(str.maketrans('', '', string.punctuation))
-    text = re.sub(r'\b(a|an|the|in|our)\b', ' ', text)
-    return re.sub(' +', ' ', text).strip()
+    text = text.lower().translate(_PUNCT_TBL)
+    text = _STOP_RE.sub(' ', text)
+    return _SPACES_RE.sub(' ', text).strip()
 
 
 def f1_score(a_gold, a_pred):
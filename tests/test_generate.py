@@ -0,0 +1,55 @@
+import torch
+
+from general_files.utils.model_util import greedy_generate, nucleus_generate
+
+EOS = 3
+VOCAB = 20
+
+
+class ScriptedModel:
+    """按预先给定的 token 序列逐步输出 logits 的假模型"""
+
+    def __init__(self, script):
+        self.script = torch.tensor(script)
+
+    def __call__(self, input_ids, past_result=None, **other_features):
+        step = input_ids.size(-1) - self.prompt_len
+        logits = torch.full((input_ids.size(0), 1, VOCAB), -1e4)
+        logits[torch.arange(input_ids.size(0)), 0, self.script[:, step]] = 1e4
+        return {"logits": logits}
+
+
+def run(generate, script, **kwargs):
+    input_ids = torch.tensor([[5, 6]] * len(script))
+    model = ScriptedModel(script)
+    model.prompt_len = input_ids.size(-1)
+    return generate(
+        input_ids=input_ids,
+        decoder_input_ids=None,
+        decoder_eos_token_id=EOS,
+        max_length=10,
+        model=model,
+        **kwargs,
+    )
+
+
+def test_rows_finishing_at_different_steps_keep_one_eos():
+    # 三个句子分别在第 1、2、4 步生成 eos，之后的输出应被忽略
+    script = [
+        [7, EOS, 9, 9, 9, 9, 9, 9, 9, 9],
+        [7, 8, EOS, 9, 9, 9, 9, 9, 9, 9],
+        [7, 8, 10, 11, EOS, 9, 9, 9, 9, 9],
+    ]
+    expected = [
+        [7, EOS, EOS, EOS, EOS],
+        [7, 8, EOS, EOS, EOS],
+        [7, 8, 10, 11, EOS],
+    ]
+    assert run(greedy_generate, script) == expected
+    assert run(nucleus_generate, script, top_k=1, top_p=1.0) == expected
+
+
+def test_unfinished_rows_run_to_max_length():
+    script = [[7] * 10, [7, EOS] + [9] * 8]
+    generated = run(greedy_generate, script)
+    assert generated == [[7] * 10, [7] + [EOS] * 9]